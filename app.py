@@ -1,9 +1,17 @@
+import mimetypes
+import io
 import os
+import secrets
+import shutil
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import quote
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, session, flash, send_from_directory
+    url_for, session, flash, send_from_directory, abort, Response
 )
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
@@ -12,22 +20,132 @@ from werkzeug.utils import secure_filename
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DB_PATH = os.path.join(BASE_DIR, "engine_diag.db")
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
-ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
+ALLOWED_EXTENSIONS = frozenset({"png", "jpg", "jpeg", "gif"})
+# Pinned so login cost doesn't drift with Werkzeug upgrades (~100ms per check)
+PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+UPLOAD_CHUNK_SIZE = 1 << 20   # 1 MiB per read/write when saving uploads
+MAX_UPLOAD_SIZE = 16 << 20    # whole request body; Flask answers 413 above this
+UPLOAD_QUEUE_LIMIT = 16        # pending background writes before writing inline
+
+# Checked against when the username doesn't exist, so login takes the same
+# time either way and can't be used to enumerate accounts
+_DUMMY_HASH = generate_password_hash("!invalid!", method=PASSWORD_HASH_METHOD)
 
 app = Flask(__name__)
 app.secret_key = "change_this_secret_key"   # change for production!
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_SIZE
+# Behind nginx, set to the internal location aliased to UPLOAD_FOLDER, e.g.
+#   location /protected-uploads/ { internal; alias /path/to/uploads/; }
+# Behind Apache with mod_xsendfile, set app.config["USE_X_SENDFILE"] = True instead.
+app.config["UPLOAD_ACCEL_REDIRECT_PREFIX"] = None
 
 
 # ----------------- DB HELPERS -----------------
-def get_db():
+_local = threading.local()
+
+
+def _connect():
+    # No "cache=shared": SQLite discourages it, and it swaps WAL's lock-free
+    # readers for table locks. mmap_size below already lets every connection
+    # (and worker process) read the same pages through the OS page cache.
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
+
+    # WAL persists in the DB file; the rest are per-connection settings
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    conn.execute("PRAGMA cache_size=-20000;")
     return conn
 
 
+def get_db():
+    """
+    One long-lived connection per worker thread, so the page cache
+    and setup above are reused across requests.
+
+    Reuse only happens under servers with persistent worker threads
+    (gunicorn sync/gthread, waitress). Flask's threaded dev server starts
+    a thread per request, so there every request connects afresh and the
+    connection is closed when its thread-local is garbage-collected.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    return conn
+
+
+@app.teardown_request
+def rollback_db(exc=None):
+    # Never leave a half-finished transaction on a reused connection
+    conn = getattr(_local, "conn", None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+# INSERT ... RETURNING needs SQLite 3.35+; older builds fall back to lastrowid
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Fixed SQL text, so sqlite3's per-connection statement cache reuses the
+# compiled statements across requests on the same thread
+_STMTS = {
+    "select_user_id": "SELECT id FROM users WHERE username = ?;",
+    "insert_user": "INSERT INTO users (username, password_hash) VALUES (?, ?);",
+    "select_login": "SELECT id, password_hash FROM users WHERE username = ?;",
+    "update_password_hash": "UPDATE users SET password_hash = ? WHERE id = ?;",
+    "select_user_cases": (
+        "SELECT id, engine_type, symptoms, image_filename, diagnosis, created_at "
+        "FROM cases WHERE user_id = ? ORDER BY id DESC;"
+    ),
+    "insert_case": (
+        "INSERT INTO cases (user_id, engine_type, symptoms, image_filename, diagnosis, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)" + (" RETURNING id;" if _HAS_RETURNING else ";")
+    ),
+    "clear_case_image": "UPDATE cases SET image_filename = NULL WHERE id = ?;",
+    "select_case": (
+        "SELECT id, engine_type, symptoms, image_filename, diagnosis, created_at "
+        "FROM cases WHERE id = ? AND user_id = ?;"
+    ),
+}
+
+
+def _migrate_cases_created_at(conn):
+    """Rebuild a pre-epoch cases table so created_at is a real INTEGER column."""
+    columns = {row["name"]: row["type"] for row in conn.execute("PRAGMA table_info(cases);")}
+    if columns.get("created_at", "").upper() != "TEXT":
+        return
+
+    # Rows hold either ISO text or epoch digits stored with TEXT affinity
+    conn.executescript("""
+        BEGIN;
+        CREATE TABLE cases_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            engine_type TEXT,
+            symptoms TEXT NOT NULL,
+            image_filename TEXT,
+            diagnosis TEXT,
+            created_at INTEGER NOT NULL,   -- unix epoch seconds (UTC)
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+        INSERT INTO cases_new (id, user_id, engine_type, symptoms, image_filename, diagnosis, created_at)
+        SELECT id, user_id, engine_type, symptoms, image_filename, diagnosis,
+               CASE WHEN created_at NOT GLOB '*[^0-9]*'
+                    THEN CAST(created_at AS INTEGER)
+                    ELSE CAST(strftime('%s', created_at) AS INTEGER)
+               END
+        FROM cases;
+        DROP TABLE cases;
+        ALTER TABLE cases_new RENAME TO cases;
+        COMMIT;
+    """)
+
+
 def init_db():
-    conn = get_db()
+    # Own connection, so the importing thread doesn't keep one open
+    conn = _connect()
     cur = conn.cursor()
 
     # Users table
@@ -48,18 +166,92 @@ def init_db():
             symptoms TEXT NOT NULL,
             image_filename TEXT,
             diagnosis TEXT,
-            created_at TEXT NOT NULL,
+            created_at INTEGER NOT NULL,   -- unix epoch seconds (UTC)
             FOREIGN KEY (user_id) REFERENCES users(id)
         );
     """)
 
+    _migrate_cases_created_at(conn)
+
+    # Dashboard lists a user's cases newest first
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_cases_user_created
+        ON cases (user_id, id DESC);
+    """)
+
+    # Nothing else needs an index: login's lookup already uses the UNIQUE
+    # autoindex on username, and view_result's cases.id is the rowid.
+
     conn.commit()
     conn.close()
 
 
 # ----------------- UTILS -----------------
 def allowed_file(filename: str) -> bool:
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, ext = filename.rpartition(".")
+    return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
+
+
+# Writes uploaded images to UPLOAD_FOLDER off the request thread
+_upload_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="upload-writer")
+_upload_slots = threading.BoundedSemaphore(UPLOAD_QUEUE_LIMIT)
+
+
+def take_upload_stream(file_storage):
+    """
+    Take ownership of an upload's buffer (Werkzeug's spooled temp file: in
+    memory up to 500 KiB, on disk above) without copying it. Werkzeug closes
+    the request's files on teardown, so leave an empty stream in its place.
+    """
+    stream = file_storage.stream
+    file_storage.stream = io.BytesIO()
+    stream.seek(0)
+    return stream
+
+
+def _persist_upload(stream, path: str, case_id: int) -> None:
+    # Large chunks, unlike FileStorage.save's 16 KiB; a temporary name keeps
+    # the image hidden until it is complete
+    part_path = path + ".part"
+    try:
+        with open(part_path, "wb", buffering=UPLOAD_CHUNK_SIZE) as dst:
+            shutil.copyfileobj(stream, dst, UPLOAD_CHUNK_SIZE)
+        os.replace(part_path, path)
+    except Exception:
+        app.logger.exception("Failed to save upload %s", path)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        # Drop the reference so the result page stops waiting for the image
+        conn = get_db()
+        with conn:
+            conn.execute(_STMTS["clear_case_image"], (case_id,))
+    finally:
+        stream.close()
+
+
+def _persist_queued_upload(stream, path: str, case_id: int) -> None:
+    try:
+        _persist_upload(stream, path, case_id)
+    finally:
+        _upload_slots.release()
+
+
+def save_upload(stream, path: str, case_id: int) -> None:
+    """
+    Write an upload for case_id to path on the writer pool. When
+    UPLOAD_QUEUE_LIMIT writes are already pending, write it inline
+    instead, so a burst of uploads can't pile up buffers without bound.
+    """
+    if not _upload_slots.acquire(blocking=False):
+        _persist_upload(stream, path, case_id)
+        return
+    _upload_executor.submit(_persist_queued_upload, stream, path, case_id)
+
+
+@app.template_filter("datetime")
+def format_timestamp(value) -> str:
+    """Render a stored created_at epoch as UTC ISO time."""
+    return datetime.fromtimestamp(value, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
 
 
 def login_required(view_func):
@@ -74,6 +266,89 @@ def login_required(view_func):
     return wrapped
 
 
+# Smoke types
+BLACK_SMOKE_SUGGESTION = (
+    "- Possible over-fuelling or restricted air supply.\n"
+    "  → Check air filter, turbocharger, fuel injectors, and boost leaks."
+)
+WHITE_SMOKE_SUGGESTION = (
+    "- Possible unburned fuel or low compression.\n"
+    "  → Check injection timing, compression, and cold-start system."
+)
+OIL_SMOKE_SUGGESTION = (
+    "- Possible oil burning.\n"
+    "  → Check turbocharger seals, valve stem seals, piston rings."
+)
+
+# Starting issues
+NO_START_SUGGESTION = (
+    "- Engine not starting.\n"
+    "  → Check battery voltage, starter motor, fuel supply, emergency stops and safety shutdowns."
+)
+
+# Knocking / noise
+KNOCK_SUGGESTION = (
+    "- Abnormal knocking noise.\n"
+    "  → Check injection timing, bearing clearances, loose connecting rods, or detonation."
+)
+
+# Overheating
+OVERHEAT_SUGGESTION = (
+    "- Engine overheating.\n"
+    "  → Check cooling water flow, thermostat, sea strainer (for marine), coolant level, and pump impeller."
+)
+
+# Low power
+LOW_POWER_SUGGESTION = (
+    "- Loss of power.\n"
+    "  → Check fuel filters, air filters, turbocharger performance, and exhaust backpressure."
+)
+
+MARINE_SUGGESTION = (
+    "- Marine-specific checks.\n"
+    "  → Inspect sea-water inlet, strainers, cooling jackets, and gearbox load."
+)
+
+NO_MATCH_SUGGESTION = (
+    "- No clear rule-based match found.\n"
+    "  → Check basics: fuel, air, compression, and lubrication. Consider AI analysis later."
+)
+
+
+def match_symptom_rules(text: str) -> list:
+    """
+    Return the suggestions triggered by the (lowercased) symptom text.
+
+    Phrases sharing a word are gated on that word, so text without it costs
+    one scan instead of one per phrase; "knock" / "overheat" also cover the
+    -ing forms. Plain `in` checks (CPython's fast search) beat both a compiled
+    "a|b|c" regex and a pyahocorasick automaton here at every text length.
+    """
+    suggestions = []
+
+    if "smoke" in text:
+        if "black smoke" in text:
+            suggestions.append(BLACK_SMOKE_SUGGESTION)
+        if "white smoke" in text:
+            suggestions.append(WHITE_SMOKE_SUGGESTION)
+        if "blue smoke" in text or "oil smoke" in text:
+            suggestions.append(OIL_SMOKE_SUGGESTION)
+
+    if "start" in text and ("no start" in text or "won't start" in text or "wont start" in text):
+        suggestions.append(NO_START_SUGGESTION)
+
+    if "knock" in text or "metallic noise" in text:
+        suggestions.append(KNOCK_SUGGESTION)
+
+    if "overheat" in text or "high temperature" in text:
+        suggestions.append(OVERHEAT_SUGGESTION)
+
+    if "power" in text and ("low power" in text or "no power" in text or "loss of power" in text):
+        suggestions.append(LOW_POWER_SUGGESTION)
+
+    return suggestions
+
+
 def suggest_solutions(engine_type: str, symptoms: str) -> str:
     """
     SIMPLE rule-based diagnostic engine.
@@ -82,67 +357,13 @@ def suggest_solutions(engine_type: str, symptoms: str) -> str:
     text = (symptoms or "").lower()
     engine = (engine_type or "").lower()
 
-    suggestions = []
-
-    # Smoke types
-    if "black smoke" in text:
-        suggestions.append(
-            "- Possible over-fuelling or restricted air supply.\n"
-            "  → Check air filter, turbocharger, fuel injectors, and boost leaks."
-        )
-    if "white smoke" in text:
-        suggestions.append(
-            "- Possible unburned fuel or low compression.\n"
-            "  → Check injection timing, compression, and cold-start system."
-        )
-    if "blue smoke" in text or "oil smoke" in text:
-        suggestions.append(
-            "- Possible oil burning.\n"
-            "  → Check turbocharger seals, valve stem seals, piston rings."
-        )
-
-    # Starting issues
-    if "no start" in text or "won't start" in text or "wont start" in text:
-        suggestions.append(
-            "- Engine not starting.\n"
-            "  → Check battery voltage, starter motor, fuel supply, emergency stops and safety shutdowns."
-        )
-
-    # Knocking / noise
-    if "knock" in text or "knocking" in text or "metallic noise" in text:
-        suggestions.append(
-            "- Abnormal knocking noise.\n"
-            "  → Check injection timing, bearing clearances, loose connecting rods, or detonation."
-        )
-
-    # Overheating
-    if "overheat" in text or "overheating" in text or "high temperature" in text:
-        suggestions.append(
-            "- Engine overheating.\n"
-            "  → Check cooling water flow, thermostat, sea strainer (for marine), coolant level, and pump impeller."
-        )
-
-    # Low power
-    if "low power" in text or "no power" in text or "loss of power" in text:
-        suggestions.append(
-            "- Loss of power.\n"
-            "  → Check fuel filters, air filters, turbocharger performance, and exhaust backpressure."
-        )
+    suggestions = match_symptom_rules(text)
 
     # Marine-specific
     if "marine" in engine or "ship" in engine:
-        suggestions.append(
-            "- Marine-specific checks.\n"
-            "  → Inspect sea-water inlet, strainers, cooling jackets, and gearbox load."
-        )
-
-    if not suggestions:
-        suggestions.append(
-            "- No clear rule-based match found.\n"
-            "  → Check basics: fuel, air, compression, and lubrication. Consider AI analysis later."
-        )
+        suggestions.append(MARINE_SUGGESTION)
 
-    return "\n\n".join(suggestions)
+    return "\n\n".join(suggestions) or NO_MATCH_SUGGESTION
 
 
 # ----------------- ROUTES: AUTH -----------------
@@ -157,23 +378,16 @@ def register():
             return redirect(url_for("register"))
 
         conn = get_db()
-        cur = conn.cursor()
 
         # Check if user exists
-        cur.execute("SELECT id FROM users WHERE username = ?;", (username,))
-        existing = cur.fetchone()
+        existing = conn.execute(_STMTS["select_user_id"], (username,)).fetchone()
         if existing:
             flash("Username already taken.", "danger")
-            conn.close()
             return redirect(url_for("register"))
 
-        password_hash = generate_password_hash(password)
-        cur.execute(
-            "INSERT INTO users (username, password_hash) VALUES (?, ?);",
-            (username, password_hash),
-        )
-        conn.commit()
-        conn.close()
+        password_hash = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+        with conn:
+            conn.execute(_STMTS["insert_user"], (username, password_hash))
 
         flash("Registration successful. Please log in.", "success")
         return redirect(url_for("login"))
@@ -188,12 +402,20 @@ def login():
         password = request.form.get("password", "")
 
         conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT id, password_hash FROM users WHERE username = ?;", (username,))
-        user = cur.fetchone()
-        conn.close()
+        user = conn.execute(_STMTS["select_login"], (username,)).fetchone()
+
+        stored_hash = user["password_hash"] if user else _DUMMY_HASH
+        password_ok = check_password_hash(stored_hash, password)
+
+        if user and password_ok:
+            # Upgrade hashes made with an older method now that we know the password
+            if not user["password_hash"].startswith(PASSWORD_HASH_METHOD + "$"):
+                with conn:
+                    conn.execute(
+                        _STMTS["update_password_hash"],
+                        (generate_password_hash(password, method=PASSWORD_HASH_METHOD), user["id"]),
+                    )
 
-        if user and check_password_hash(user["password_hash"], password):
             session["user_id"] = user["id"]
             session["username"] = username
             flash("Logged in successfully.", "success")
@@ -225,14 +447,7 @@ def index():
 def dashboard():
     user_id = session["user_id"]
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, engine_type, symptoms, image_filename, diagnosis, created_at "
-        "FROM cases WHERE user_id = ? ORDER BY id DESC;",
-        (user_id,),
-    )
-    cases = cur.fetchall()
-    conn.close()
+    cases = conn.execute(_STMTS["select_user_cases"], (user_id,)).fetchall()
     return render_template("dashboard.html", cases=cases)
 
 
@@ -249,31 +464,40 @@ def diagnose():
             return redirect(url_for("diagnose"))
 
         image_filename = None
+        image_stream = None
         if image_file and image_file.filename:
             if allowed_file(image_file.filename):
                 filename = secure_filename(image_file.filename)
                 name, ext = os.path.splitext(filename)
-                filename = f"{name}_{int(datetime.now().timestamp())}{ext}"
-                image_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-                image_file.save(image_path)
+                # Random suffix: unique even for two uploads of the same name in one second
+                filename = f"{name}_{secrets.token_urlsafe(8)}{ext}"
+                image_stream = take_upload_stream(image_file)
                 image_filename = filename
             else:
                 flash("Invalid image format. Use png/jpg/jpeg/gif.", "danger")
                 return redirect(url_for("diagnose"))
 
         diagnosis_text = suggest_solutions(engine_type, symptoms)
-        created_at = datetime.utcnow().isoformat(timespec="seconds")
+        created_at = int(time.time())
 
         conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO cases (user_id, engine_type, symptoms, image_filename, diagnosis, created_at) "
-            "VALUES (?, ?, ?, ?, ?, ?);",
-            (session["user_id"], engine_type, symptoms, image_filename, diagnosis_text, created_at),
-        )
-        conn.commit()
-        case_id = cur.lastrowid
-        conn.close()
+        try:
+            with conn:
+                cur = conn.execute(
+                    _STMTS["insert_case"],
+                    (session["user_id"], engine_type, symptoms, image_filename, diagnosis_text, created_at),
+                )
+                # Read the RETURNING row before the commit finalises the statement
+                case_id = cur.fetchone()[0] if _HAS_RETURNING else cur.lastrowid
+        except Exception:
+            if image_stream is not None:
+                image_stream.close()
+            raise
+
+        # Row is committed; the image is written while the redirect goes out
+        if image_stream is not None:
+            image_path = os.path.join(app.config["UPLOAD_FOLDER"], image_filename)
+            save_upload(image_stream, image_path, case_id)
 
         return redirect(url_for("view_result", case_id=case_id))
 
@@ -284,30 +508,39 @@ def diagnose():
 @login_required
 def view_result(case_id):
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, engine_type, symptoms, image_filename, diagnosis, created_at "
-        "FROM cases WHERE id = ? AND user_id = ?;",
-        (case_id, session["user_id"]),
-    )
-    case = cur.fetchone()
-    conn.close()
+    case = conn.execute(_STMTS["select_case"], (case_id, session["user_id"])).fetchone()
 
     if not case:
         flash("Case not found.", "danger")
         return redirect(url_for("dashboard"))
 
-    return render_template("result.html", case=case)
+    image_ready = bool(case["image_filename"]) and os.path.exists(
+        os.path.join(app.config["UPLOAD_FOLDER"], case["image_filename"])
+    )
+    return render_template("result.html", case=case, image_ready=image_ready)
 
 
 @app.route("/uploads/<filename>")
 @login_required
 def uploaded_file(filename):
+    prefix = app.config["UPLOAD_ACCEL_REDIRECT_PREFIX"]
+    if prefix:
+        # Auth is checked here; nginx then sends the file itself. Uploads are
+        # always saved under secure names, so anything else can't exist.
+        if secure_filename(filename) != filename:
+            abort(404)
+        return Response(headers={"X-Accel-Redirect": prefix.rstrip("/") + "/" + quote(filename)},
+                        mimetype=mimetypes.guess_type(filename)[0])
     return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
 
 
+# ----------------- STARTUP -----------------
+# Runs on import, so `flask run` and gunicorn get the schema and migrations
+# too, not only `python app.py`
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+init_db()
+
+
 # ----------------- MAIN -----------------
 if __name__ == "__main__":
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    init_db()
     app.run(host="0.0.0.0", port=5000, debug=True)